@@ -4,20 +4,81 @@ API of Central Bank of Russia and National Bank of Ukraine.
 Verison: 1.0.0
 
 """
+import asyncio
+import concurrent.futures
+import contextlib
 import datetime
+from decimal import Decimal
 from email.message import EmailMessage
+import functools
+import logging
+import logging.handlers
 import pprint
+import queue
 import smtplib
-import xml.etree.ElementTree as ET
+import sys
+import threading
+import weakref
 
+import aiohttp
+from lxml import etree as ET
 import psycopg2
-import requests
+import psycopg2.extras
+import psycopg2.pool
 
 from settings import DATABASE, EMAIL
 
+logger = logging.getLogger(__name__)
 
-def get_cursor(db_host, db_port, db_user, db_password, db_name):
-    """ Return database connection and cursor.
+# Size of database connection pool, the connections are opened at once
+# and kept open, as the pool closes returned connections above minimum.
+POOL_CONNECTIONS = 4
+
+# Connections, for which statement save_rate has been prepared
+PREPARED_CONNECTIONS = weakref.WeakSet()
+PREPARED_CONNECTIONS_LOCK = threading.Lock()
+
+# Retry policy for requests to API of the banks
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Number of requests made to a bank at once, the rest wait for their
+# turn before the request timeout starts
+CONCURRENT_REQUESTS = 16
+
+# Size of chunks response body is fed to parser in
+CHUNK_SIZE = 64 * 1024
+
+# Translation table for rates using comma as decimal separator
+DECIMAL_TABLE = str.maketrans(',', '.')
+
+
+def setup_logging(level):
+    """ Configure logging, so that messages are queued by the calling
+    thread and written to stdout by a listener thread.
+
+    Arguments:
+    level -- logging level, e.g. logging.INFO.
+
+    Return:
+    listener -- started queue listener, stop it to flush the messages.
+
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+def get_pool(db_host, db_port, db_user, db_password, db_name):
+    """ Return pool of database connections, which can be shared
+    between threads.
 
     Arguments:
     db_host
@@ -27,30 +88,80 @@ def get_cursor(db_host, db_port, db_user, db_password, db_name):
     db_name
 
     Return:
-    connection 
-    cursor
+    pool
 
     """
-    connection = psycopg2.connect(
+    return psycopg2.pool.ThreadedConnectionPool(
+        POOL_CONNECTIONS, POOL_CONNECTIONS,
         host=db_host, port=db_port, user=db_user,
         password=db_password, dbname=db_name
     )
-    cursor = connection.cursor()
-    return (connection, cursor)
 
 
-def get_url_list(
+@contextlib.contextmanager
+def pooled_cursor(pool):
+    """ Get cursor of connection from pool and return the connection
+    back afterwards.
+
+    The transaction is committed if the block succeeds and rolled back
+    otherwise, in which case the connection is closed.
+
+    Arguments:
+    pool -- pool returned by get_pool method.
+
+    """
+    connection = pool.getconn()
+    failed = False
+    try:
+        with connection.cursor() as cursor:
+            yield cursor
+        connection.commit()
+    except BaseException:
+        failed = True
+        connection.rollback()
+        raise
+    finally:
+        # Connection is not reused after failure, its session state,
+        # e.g. prepared statements, may be inconsistent.
+        pool.putconn(connection, close=failed)
+
+
+async def run_with_cursor(pool, executor, func):
+    """ Call function with pooled cursor in a separate thread.
+
+    Arguments:
+    pool -- pool returned by get_pool method;
+    executor -- thread pool, which should not have more threads than
+        the pool has connections;
+    func -- function to be called, cursor is passed as its only
+        argument.
+
+    Return:
+    result -- result of the function
+
+    """
+    def call():
+        with pooled_cursor(pool) as cursor:
+            return func(cursor)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, call)
+
+
+def get_download_lists(
         cursor, var_in_crncy_id,
         var_check_min_threshold=True,
-        var_min_threshold=(
-            datetime.datetime.now().date()-datetime.timedelta(days=7)),
-        var_max_date=datetime.datetime.now().date()):
-    """ Get a list of URLs to be called.
+        var_min_threshold=None,
+        var_max_date=None):
+    """ Get a list of URLs to be called and a list of currencies,
+    exchange rates for which are needed to be downloaded.
+
+    Both lists are returned by database in one round-trip.
 
     Arguments:
-    cursor -- cursor returned by get_cursor method;
+    cursor -- cursor returned by pooled_cursor context manager;
     var_in_crncy_id -- pass 2 or 8 (ID for RUB and UAH in database)
-        to get a list of URLs for Central Bank of Russia or
+        to get lists for Central Bank of Russia or
         National Bank of Ukraine;
     var_check_min_threshold -- set to False if currency exchange rates
         for all of the available dates should be downloaded, set to True
@@ -62,188 +173,533 @@ def get_url_list(
         '11-30-2018'::date (the default is today).
 
     Return:
-    url_list -- a list of URLs to be called at the next step.
+    url_list -- a list of URLs to be called at the next step;
+    crncy_list -- a list of currencies to be checked upon at the
+        next step.
 
     """
-    print('Getting URL list...')
+    if var_min_threshold is None:
+        var_min_threshold = \
+            datetime.date.today() - datetime.timedelta(days=7)
+    if var_max_date is None:
+        var_max_date = datetime.date.today()
+
+    logger.info('Getting URL and currency lists...')
     cursor.execute(
-        "SELECT * FROM currency.f_crncy_downldr_return_url(%s, %s, %s, %s)",
+        "SELECT urls, crncies FROM currency.f_crncy_downldr_return_bundle(\
+            %s, %s, %s, %s)",
         (
             var_in_crncy_id, var_check_min_threshold,
             var_min_threshold, var_max_date
         ))
-    url_list = {}
-    row = cursor.fetchone()
-    while row is not None:
-        url_list[row[0]] = row[1]
-        row = cursor.fetchone()
-    cursor.execute("COMMIT")
-    return url_list
+    urls, crncies = cursor.fetchone()
+    url_list = {
+        datetime.date.fromisoformat(date): url
+        for date, url in (urls or {}).items()}
+    crncy_list = {
+        ident: datetime.date.fromisoformat(date)
+        for ident, date in (crncies or {}).items()}
+    return url_list, crncy_list
 
 
-def get_crncy_list(
-        cursor, var_in_crncy_id,
-        var_check_min_threshold=True,
-        var_min_threshold=(
-            datetime.datetime.now().date()-datetime.timedelta(days=7))):
-    """ Get a list of currencies, exchange rates for which are needed
-    to be downloaded.
+def get_session():
+    """ Return HTTP client session.
+
+    The session keeps connections to a bank alive between requests and
+    asks for compressed responses.
+
+    Return:
+    session -- aiohttp client session
+
+    """
+    connector = aiohttp.TCPConnector(limit=CONCURRENT_REQUESTS)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=30),
+        headers={'Accept-Encoding': 'gzip'})
+
+
+def get_http_cache(cursor, urls, cache_key):
+    """ Get ETag and Last-Modified headers of previously downloaded URLs.
+
+    Headers are returned only for URLs downloaded for the same list of
+    currencies, e.g. a newly enabled currency makes all of the URLs to
+    be downloaded again.
 
     Arguments:
-    cursor -- cursor returned by get_cursor method;
-    var_in_crncy_id -- pass 2 or 8 (ID for RUB and UAH in database)
-        to get a list of URLs for Central Bank of Russia or
-        National Bank of Ukraine;
-    var_check_min_threshold -- set to False if currency exchange rates
-        for all of the available dates should be downloaded, set to True
-        (this is the default) to specify the date to start downloading
-        rates from (is used to exclude unnecessary data);
-    var_min_threshold -- if previous argument is set to True, specify
-        this minimum date (the default is minus 7 days from today).
+    cursor -- cursor returned by pooled_cursor context manager;
+    urls -- URLs to be requested;
+    cache_key -- identificators of the currencies to be downloaded,
+        as returned by get_cache_key method.
 
     Return:
-    crncy_list -- a list of currencies to be checked upon at the
-        next step.
+    http_cache -- ETag and Last-Modified headers by URL.
 
     """
-    print('Getting currency list...')
     cursor.execute(
-        "SELECT * FROM currency.f_crncy_downldr_return_crncs(%s, %s, %s)",
-        (var_in_crncy_id, var_check_min_threshold, var_min_threshold))
-    crncy_list = {}
-    row = cursor.fetchone()
-    while row is not None:
-        crncy_list[row[0]] = row[1]
-        row = cursor.fetchone()
-    cursor.execute("COMMIT")
-    return crncy_list
-
-
-def download_rates(url_list, crncy_list, var_in_crncy_id):
+        "SELECT * FROM currency.f_crncy_downldr_return_http_cache(%s, %s)",
+        (list(urls), cache_key))
+    return {
+        url: (etag, last_modified)
+        for url, etag, last_modified in cursor.fetchall()}
+
+
+def save_http_cache(cursor, http_cache, cache_key):
+    """ Save ETag and Last-Modified headers of downloaded URLs.
+
+    Arguments:
+    cursor -- cursor returned by pooled_cursor context manager;
+    http_cache -- ETag and Last-Modified headers by URL;
+    cache_key -- identificators of the currencies the URLs have been
+        downloaded for, as returned by get_cache_key method.
+
+    """
+    psycopg2.extras.execute_batch(
+        cursor,
+        "SELECT currency.f_crncy_downldr_save_http_cache(%s, %s, %s, %s)",
+        [
+            (url, etag, last_modified, cache_key)
+            for url, (etag, last_modified) in http_cache.items()
+        ],
+        page_size=100)
+
+
+def get_cache_key(crncy_list):
+    """ Return key of HTTP cache, which is identificators of the
+    currencies as a string, not depending on order of the list.
+
+    Arguments:
+    crncy_list -- a list of currencies as returned by
+        get_download_lists method.
+
+    Return:
+    cache_key -- sorted comma separated identificators
+
+    """
+    return ",".join(sorted(crncy_list))
+
+
+def make_cbr_parser():
+    """ Return parser for CBR document, which reports each of the
+    currencies once it is parsed.
+
+    Return:
+    parser
+
+    """
+    return ET.XMLPullParser(events=('end',), tag='Valute')
+
+
+def make_nbu_parser():
+    """ Return parser for NBU document, which reports each of the
+    currencies once it is parsed.
+
+    Return:
+    parser
+
+    """
+    # NBU documents are UTF-8 encoded, do not rely on declaration
+    return ET.XMLPullParser(
+        events=('end',), tag='currency', encoding='utf-8')
+
+
+async def fetch(
+        session, semaphore, date, url, make_parser, parse_data,
+        validators=None):
+    """ Make request for URL and get exchange rates to be saved.
+
+    The body is fed to parser chunk by chunk while it is being
+    downloaded, so that parsing overlaps with network transfer, and the
+    currencies parsed so far are processed and released after each
+    chunk, so that the whole document is never kept in memory. Request
+    is retried with exponential backoff on timeouts, connection
+    errors and statuses from RETRY_STATUSES. If validators are given,
+    request is conditional and the body is not downloaded again unless
+    it has changed.
+
+    Request waits for semaphore before it is sent, so that time spent
+    in the queue does not count towards its timeout.
+
+    Arguments:
+    session -- client session returned by get_session method;
+    semaphore -- semaphore limiting the number of requests made at
+        once to CONCURRENT_REQUESTS;
+    date -- date the request is made for;
+    url -- URL to be requested;
+    make_parser -- make_cbr_parser or make_nbu_parser method;
+    parse_data -- parse_cbr_data or parse_nbu_data method, taking date
+        and parser events only;
+    validators -- ETag and Last-Modified headers of previous response
+        as returned by get_http_cache method.
+
+    Return:
+    date -- date the request has been made for
+    rows -- arguments for saving exchange rates to database or None if
+        request has failed or the body has not been modified
+    email_body_date -- lines of email body, containing list of
+        downloaded exchange rates
+    validators -- ETag and Last-Modified headers of response or None
+        if there is nothing new to be cached
+
+    """
+    headers = {}
+    if validators is not None:
+        etag, last_modified = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    logger.debug('Making request for url %s', url)
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(BACKOFF_FACTOR * 2 ** (attempt - 1))
+        try:
+            async with semaphore, \
+                    session.get(url, headers=headers) as response:
+                if response.status in RETRY_STATUSES \
+                        and attempt < MAX_RETRIES:
+                    continue
+                if response.status == 304:
+                    logger.debug('Not modified, url: %s', url)
+                    return date, None, None, None
+                response.raise_for_status()
+                parser = make_parser()
+                rows = []
+                email_body_date = []
+                async for chunk in response.content.iter_chunked(
+                        CHUNK_SIZE):
+                    parser.feed(chunk)
+                    parse_data(date, parser.read_events(), rows,
+                               email_body_date)
+                parser.close()
+                parse_data(date, parser.read_events(), rows, email_body_date)
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+                if etag or last_modified:
+                    return date, rows, email_body_date, (etag, last_modified)
+                return date, rows, email_body_date, None
+        except ET.XMLSyntaxError:
+            logger.error("ERROR parsing url: %s", url)
+            break
+        except asyncio.TimeoutError:
+            logger.error("ERROR timeout, url: %s", url)
+        except aiohttp.ClientResponseError as err:
+            logger.error("ERROR url: %s, code: %s", url, err.status)
+            break
+        except aiohttp.ClientError:
+            logger.error("ERROR downloading url: %s", url)
+    return date, None, None, None
+
+
+async def download_rates(
+        url_list, crncy_list, var_in_crncy_id, pool, executor):
     """ Make requests for URLs to get exchange rates.
 
+    Requests are made concurrently and parsed while being received,
+    exchange rates are saved to database afterwards, each date in its
+    own thread and transaction. Requests for URLs downloaded before for
+    the same list of currencies are conditional, unchanged responses
+    are not parsed again.
+
     Arguments:
-    url_list -- a list of URLs to be requested as returned by get_url_list
-        method;
+    url_list -- a list of URLs to be requested as returned by
+        get_download_lists method;
     crncy_list -- a list of currencies, exchange rates for which are
         needed to be downloaded;
     var_in_crncy_id -- pass 2 or 8 (ID for RUB and UAH in database)
         to get a list of URLs for Central Bank of Russia or
         National Bank of Ukraine;
+    pool -- pool returned by get_pool method;
+    executor -- thread pool to work with database in, see
+        run_with_cursor method.
 
     Return:
     has_result_to_send -- True if anything has been saved to database
     email_body -- email body to be sent
 
     """
-    email_body = "Downloaded exchange rates from CBR:\n\n" \
-        if var_in_crncy_id == 2 else "Downloaded exchange rates from NBU :\n\n"
+    email_body = ["Downloaded exchange rates from CBR:\n\n"
+                  if var_in_crncy_id == 2
+                  else "Downloaded exchange rates from NBU :\n\n"]
     has_result_to_send = False
-    for key, value in url_list.items():
-        date = key
-        url = value
-        email_body_date = ""
-        try:
-            print('Making request for url {}'.format(url))
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
-        except requests.Timeout:
-            print("ERROR timeout, url:", url)
-        except requests.HTTPError as err:
-            code = err.response.status_code
-            print("ERROR url: {0}, code: {1}".format(url, code))
-        except requests.RequestException:
-            print("ERROR downloading url: ", url)
-        else:
-            email_body_date = email_body_date + save_data(
-                date, response, var_in_crncy_id, crncy_list)
-        if email_body_date != "":
-            email_body = email_body + \
-                "***** Exchange rates on date {} *****".format(date) + \
-                "\n" + email_body_date + "\n"
-            has_result_to_send = True
-    return has_result_to_send, email_body
-
-
-def save_data(date, response, var_in_crncy_id, crncy_list):
-    """ Save data to database.
+
+    cache_key = get_cache_key(crncy_list)
+
+    http_cache = await run_with_cursor(
+        pool, executor,
+        functools.partial(
+            get_http_cache, urls=list(url_list.values()),
+            cache_key=cache_key))
+    if var_in_crncy_id == 2:
+        make_parser, parse_data = make_cbr_parser, parse_cbr_data
+    else:
+        make_parser, parse_data = make_nbu_parser, parse_nbu_data
+    parse_data = functools.partial(
+        parse_data, var_in_crncy_id=var_in_crncy_id,
+        crncy_list=crncy_list)
+    semaphore = asyncio.Semaphore(CONCURRENT_REQUESTS)
+    async with get_session() as session:
+        responses = await asyncio.gather(*[
+            fetch(
+                session, semaphore, date, url, make_parser, parse_data,
+                http_cache.get(url))
+            for date, url in url_list.items()])
+
+    # Each date is saved in a separate thread using its own connection
+    downloaded = [
+        (date, rows, email_body_date)
+        for date, rows, email_body_date, _ in responses if rows]
+    await asyncio.gather(*[
+        run_with_cursor(
+            pool, executor, functools.partial(save_data, rows=rows))
+        for _, rows, _ in downloaded])
+
+    for date, _, email_body_date in downloaded:
+        email_body.append(
+            f"***** Exchange rates on date {date} *****\n"
+            f"{''.join(email_body_date)}\n")
+        has_result_to_send = True
+
+    new_http_cache = {
+        url: validators
+        for (*_, validators), url in zip(responses, url_list.values())
+        if validators is not None}
+    if new_http_cache:
+        await run_with_cursor(
+            pool, executor,
+            functools.partial(
+                save_http_cache, http_cache=new_http_cache,
+                cache_key=cache_key))
+    return has_result_to_send, "".join(email_body)
+
+
+async def run_bank(
+        var_in_crncy_id, pool, executor, var_check_min_threshold,
+        var_min_threshold, var_max_date):
+    """ Download exchange rates from a bank.
 
     Arguments:
-    date -- date the request is made for;
-    response -- returned after making successful request;
     var_in_crncy_id -- pass 2 or 8 (ID for RUB and UAH in database)
-        to get a list of URLs for Central Bank of Russia or
+        to download rates from Central Bank of Russia or
         National Bank of Ukraine;
-    crncy_list -- a list of currencies, exchange rates for which are
-        needed to be downloaded;
+    pool -- pool returned by get_pool method;
+    executor -- thread pool to work with database in, see
+        run_with_cursor method;
+    var_check_min_threshold -- see get_download_lists method;
+    var_min_threshold -- see get_download_lists method;
+    var_max_date -- see get_download_lists method.
+
+    Return:
+    has_result_to_send -- True if anything has been saved to database
+    email_body -- email body to be sent
+
+    """
+    url_list, crncy_list = await run_with_cursor(
+        pool, executor,
+        functools.partial(
+            get_download_lists,
+            var_in_crncy_id=var_in_crncy_id,
+            var_check_min_threshold=var_check_min_threshold,
+            var_min_threshold=var_min_threshold,
+            var_max_date=var_max_date))
+    return await download_rates(
+        url_list, crncy_list, var_in_crncy_id, pool, executor)
+
+
+async def run_banks(
+        pool, crncy_ids, var_check_min_threshold,
+        var_min_threshold, var_max_date):
+    """ Download exchange rates from the banks concurrently.
+
+    Arguments:
+    pool -- pool returned by get_pool method, each thread working with
+        database takes its own connection from it;
+    crncy_ids -- IDs of currencies of the banks, see run_bank method;
+    var_check_min_threshold -- see get_download_lists method;
+    var_min_threshold -- see get_download_lists method;
+    var_max_date -- see get_download_lists method.
 
     Return:
-    email_body_date -- body for email, containing list of downloaded
-        exchange rates.
-    
+    results -- has_result_to_send and email_body for each of the banks
+
+    """
+    # No more threads than connections, so that the pool is never
+    # exhausted.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=POOL_CONNECTIONS) as executor:
+        return await asyncio.gather(*[
+            run_bank(
+                var_in_crncy_id, pool, executor,
+                var_check_min_threshold, var_min_threshold, var_max_date)
+            for var_in_crncy_id in crncy_ids])
+
+
+@functools.lru_cache(maxsize=32)
+def parse_cbr_date(value):
+    """ Convert date of CBR document, e.g. '25.05.2019', to date.
+
+    Arguments:
+    value -- 'Date' attribute of 'ValCurs' element.
+
+    Return:
+    date
+
+    """
+    return datetime.datetime.strptime(value, "%d.%m.%Y").date()
+
+
+def to_decimal(value):
+    """ Convert exchange rate, e.g. '65,1234', to Decimal.
+
+    Arguments:
+    value -- exchange rate as given by API of the bank.
+
+    Return:
+    rate -- Decimal, so that the rate is saved without rounding errors
+
     """
-    root = ET.fromstring(response.text)
-    # print(root)
-    # print(root.tag)
-    # print(root.attrib)
-    email_body_date = ""
-
-    for currency in root:
-        if var_in_crncy_id == 2:
-            # print(currency.tag, currency.attrib['ID'])
-
-            # Currency identificator is present in list of currencie
-            # and the URL date is fresher than the latest date when 
-            # exchange rates where previously downloaded.
-            if currency.attrib['ID'] in crncy_list:
-                if date > crncy_list[currency.attrib['ID']] \
-                    and date == datetime.datetime.strptime(
-                        root.attrib['Date'], "%d.%m.%Y").date():
-                    crncy = {'Identificator': currency.attrib['ID'],}
-                    for detail in currency:
-                        crncy[detail.tag] = detail.text
-                    print('Saving {} on {} to DB...'.format(
-                        crncy['Identificator'], date))
-                    cur.execute(
-                        "SELECT * FROM currency.f_crncy_downldr_save_rate(\
-                                %s, %s, %s, %s, %s)",
-                        (
-                            var_in_crncy_id, 
-                            crncy['Identificator'],
-                            date,
-                            crncy['Nominal'],
-                            float(crncy['Value'].replace(',', '.'))))
-                    cur.execute("COMMIT")
-                    print("Successfully done!")
-                    email_body_date = email_body_date + "{}: {}/{}".format(
-                        crncy['CharCode'],
-                        crncy['Value'],
-                        crncy['Nominal']
-                    ) + "\n"
-        else:
+    return Decimal(value.translate(DECIMAL_TABLE))
+
+
+def parse_cbr_data(
+        date, events, rows, email_body_date,
+        var_in_crncy_id, crncy_list):
+    """ Get exchange rates to be saved from currencies of CBR document
+    parsed so far.
+
+    Processed currencies are released as the events are read.
+
+    Arguments:
+    date -- date the request is made for;
+    events -- events read from parser returned by make_cbr_parser
+        method;
+    rows -- arguments for saving exchange rates to database, which
+        are appended to;
+    email_body_date -- lines of email body, containing list of
+        downloaded exchange rates, which are appended to;
+    var_in_crncy_id -- ID for RUB in database;
+    crncy_list -- a list of currencies, exchange rates for which are
+        needed to be downloaded.
+
+    """
+    for _, currency in events:
+        # Currency identificator is present in list of currencie
+        # and the URL date is fresher than the latest date when 
+        # exchange rates where previously downloaded.
+        ident = currency.attrib['ID']
+        latest_date = crncy_list.get(ident)
+        if latest_date is not None and date > latest_date \
+                and date == parse_cbr_date(
+                    currency.getparent().attrib['Date']):
+            crncy = {'Identificator': ident,}
+            for detail in currency:
+                crncy[detail.tag] = detail.text
+            logger.debug(
+                'Saving %s on %s to DB...', crncy['Identificator'], date)
+            rows.append((
+                var_in_crncy_id,
+                crncy['Identificator'],
+                date,
+                crncy['Nominal'],
+                to_decimal(crncy['Value'])))
+            email_body_date.append(
+                f"{crncy['CharCode']}: {crncy['Value']}/"
+                f"{crncy['Nominal']}\n")
+
+        # Release processed currency along with the preceding ones
+        currency.clear()
+        while currency.getprevious() is not None:
+            del currency.getparent()[0]
+
+
+def parse_nbu_data(
+        date, events, rows, email_body_date,
+        var_in_crncy_id, crncy_list):
+    """ Get exchange rates to be saved from currencies of NBU document
+    parsed so far.
+
+    Processed currencies are released as the events are read.
+
+    Arguments:
+    date -- date the request is made for;
+    events -- events read from parser returned by make_nbu_parser
+        method;
+    rows -- arguments for saving exchange rates to database, which
+        are appended to;
+    email_body_date -- lines of email body, containing list of
+        downloaded exchange rates, which are appended to;
+    var_in_crncy_id -- ID for UAH in database;
+    crncy_list -- a list of currencies, exchange rates for which are
+        needed to be downloaded.
+
+    """
+    for _, currency in events:
+        # Currency code is present in list of currencies and the URL
+        # date is fresher than the latest date when exchange rates
+        # where previously downloaded.
+        ident = currency.findtext('r030')
+        latest_date = crncy_list.get(ident)
+        if latest_date is not None and date > latest_date:
             crncy = {}
             for detail in currency:
                 crncy[detail.tag] = detail.text
-            if crncy['r030'] in crncy_list \
-                    and date > crncy_list[crncy['r030']]:
-                print('Saving {} on {} to DB...'.format(crncy['r030'], date))
-                cur.execute(
-                    "SELECT * FROM currency.f_crncy_downldr_save_rate(\
-                        %s, %s, %s, %s, %s)",
-                    (
-                        var_in_crncy_id,
-                        crncy['r030'],
-                        date,
-                        1,
-                        float(crncy['rate'].replace(',', '.'))))
-                cur.execute("COMMIT")
-                print("Successfully done!")
-                email_body_date = email_body_date + "{}: {}/{}".format(
-                    crncy['cc'],
-                    crncy['rate'],
-                    1
-                ) + "\n"
-    return email_body_date
+            logger.debug('Saving %s on %s to DB...', crncy['r030'], date)
+            rows.append((
+                var_in_crncy_id,
+                crncy['r030'],
+                date,
+                1,
+                to_decimal(crncy['rate'])))
+            email_body_date.append(f"{crncy['cc']}: {crncy['rate']}/1\n")
+
+        # Release processed currency along with the preceding ones
+        currency.clear()
+        while currency.getprevious() is not None:
+            del currency.getparent()[0]
+
+
+def save_rates(cursor, rows):
+    """ Save exchange rates to database in one round-trip.
+
+    Rates are saved through statement save_rate, so that the call is not
+    parsed by database over and over again. The statement is prepared
+    along with the first rates saved by a connection and lasts until
+    the connection is closed.
+
+    Arguments:
+    cursor -- cursor returned by pooled_cursor context manager;
+    rows -- arguments for saving exchange rates to database.
+
+    """
+    connection = cursor.connection
+    with PREPARED_CONNECTIONS_LOCK:
+        is_prepared = connection in PREPARED_CONNECTIONS
+    statements = [
+        cursor.mogrify("EXECUTE save_rate(%s, %s, %s, %s, %s)", row)
+        for row in rows]
+    if not is_prepared:
+        statements.insert(0, (
+            b"PREPARE save_rate(integer, text, date, integer, numeric) AS "
+            b"SELECT currency.f_crncy_downldr_save_rate($1, $2, $3, $4, $5)"))
+    cursor.execute(b";".join(statements))
+    if not is_prepared:
+        with PREPARED_CONNECTIONS_LOCK:
+            PREPARED_CONNECTIONS.add(connection)
+
+
+def save_data(rows, cursor):
+    """ Save data to database.
+
+    Arguments:
+    rows -- arguments for saving exchange rates to database as built
+        by parse_cbr_data or parse_nbu_data method;
+    cursor -- cursor returned by pooled_cursor context manager.
+
+    """
+    # Save all of the rates for the date in one go
+    save_rates(cursor, rows)
+    logger.info("Successfully done!")
 
 
 def send_email(
@@ -274,18 +730,6 @@ def send_email(
     s.quit()
 
 
-def cleanup(cursor, connection):
-    """ Close cursor and connection to database.
-
-    Arguments:
-    cursor
-    connection
-
-    """
-    cursor.close()
-    connection.close()
-
-
 if __name__ == "__main__":
 
     # Use Russian ruble ID to make requests to API of Central Bank of
@@ -299,46 +743,54 @@ if __name__ == "__main__":
     MIN_DATE = datetime.date(2019, 5, 5)
     MAX_DATE = datetime.datetime.now().date()
 
-    print("***** Started my job at " + str(datetime.datetime.today()) + " *****")
+    # Set to logging.DEBUG to log every request and saved exchange rate
+    LOG_LEVEL = logging.INFO
 
-    # Establish database connection and get cursor
-    conn, cur = get_cursor(
-        DATABASE['HOST'], DATABASE['PORT'], DATABASE['USER'],
-        DATABASE['PASSWORD'], DATABASE['NAME']
-    )
+    # Log messages are written to stdout by a separate thread
+    listener = setup_logging(LOG_LEVEL)
 
-    # Get currency exchange rates from Central Bank of Russia
-    url_list = get_url_list(
-        cur, ID_CBR, CHECK_MIN_THRESHOLD, MIN_DATE, MAX_DATE)
-    crncy_list = get_crncy_list(cur, ID_CBR, CHECK_MIN_THRESHOLD, MIN_DATE)
-    cbr_has_result_to_send, email_body_cbr = download_rates(
-        url_list, crncy_list, ID_CBR)
-
-    # Get currency exchange rates from National Bank of Ukraine
-    url_list = get_url_list(
-        cur, ID_NBU, CHECK_MIN_THRESHOLD, MIN_DATE, MAX_DATE)
-    crncy_list = get_crncy_list(cur, ID_NBU, CHECK_MIN_THRESHOLD, MIN_DATE)
-    nbu_has_result_to_send, email_body_nbu = download_rates(
-        url_list, crncy_list, ID_NBU)
-
-    # Form Email body
-    email_body = ""
-    if cbr_has_result_to_send and not nbu_has_result_to_send:
-        email_body = email_body + email_body_cbr
-    elif cbr_has_result_to_send and nbu_has_result_to_send:
-        email_body = email_body_cbr + '\n\n' + email_body_nbu
-    elif not cbr_has_result_to_send and nbu_has_result_to_send:
-        email_body = email_body + email_body_nbu
-
-    # Send Email if any exchange rates have been downloaded
-    if email_body != "":
-        send_email(
-            email_body, EMAIL['SUBJECT'], EMAIL['FROM'], EMAIL['TO'],
-            EMAIL['HOST'], EMAIL['PORT'], EMAIL['LOGIN'], EMAIL['PASSWORD']
-        )
+    # Stop the listener in any case, so that queued messages, e.g. the
+    # ones explaining a failure, are written out.
+    try:
+        logger.info(
+            "***** Started my job at %s *****", datetime.datetime.today())
 
-    # Close database connection and cursor
-    cleanup(cur, conn)
+        # Establish database connections
+        pool = get_pool(
+            DATABASE['HOST'], DATABASE['PORT'], DATABASE['USER'],
+            DATABASE['PASSWORD'], DATABASE['NAME']
+        )
 
-    print("***** Finished my job at " + str(datetime.datetime.today()) + \
-        " *****\n")
+        # Get currency exchange rates from Central Bank of Russia and
+        # National Bank of Ukraine at the same time
+        try:
+            (
+                (cbr_has_result_to_send, email_body_cbr),
+                (nbu_has_result_to_send, email_body_nbu)
+            ) = asyncio.run(run_banks(
+                pool, (ID_CBR, ID_NBU),
+                CHECK_MIN_THRESHOLD, MIN_DATE, MAX_DATE))
+        finally:
+            # Close database connections
+            pool.closeall()
+
+        # Form Email body
+        email_body = ""
+        if cbr_has_result_to_send and not nbu_has_result_to_send:
+            email_body = email_body + email_body_cbr
+        elif cbr_has_result_to_send and nbu_has_result_to_send:
+            email_body = email_body_cbr + '\n\n' + email_body_nbu
+        elif not cbr_has_result_to_send and nbu_has_result_to_send:
+            email_body = email_body + email_body_nbu
+
+        # Send Email if any exchange rates have been downloaded
+        if email_body != "":
+            send_email(
+                email_body, EMAIL['SUBJECT'], EMAIL['FROM'], EMAIL['TO'],
+                EMAIL['HOST'], EMAIL['PORT'], EMAIL['LOGIN'], EMAIL['PASSWORD']
+            )
+
+        logger.info(
+            "***** Finished my job at %s *****\n", datetime.datetime.today())
+    finally:
+        listener.stop()